@@ -1,9 +1,15 @@
 """
 Simple Flask backend for Jenkins chatbot.
 Clean, easy-to-understand implementation.
+
+Development:  python app.py
+Production:   gunicorn -c gunicorn.conf.py app:app
 """
 import logging
-from flask import Flask, request, jsonify
+from typing import Any, Optional
+import orjson
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
 from config import config
@@ -17,22 +23,70 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson for request parsing and jsonify."""
+
+    def dumps(self, obj: Any, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        # Skip the str round trip and hand orjson's bytes straight to the response
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype='application/json'
+        )
+
+
+def sse_event(payload: dict) -> bytes:
+    """Encode a payload as one Server-Sent Event."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
 # Create Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = config.SECRET_KEY
 
 # Enable CORS
 CORS(app, origins=config.CORS_ORIGINS)
 
 
+# Health responses are fixed, so serialize them once
+MODEL_READY = False
+_HEALTHY_BODY = orjson.dumps({'status': 'healthy', 'model_loaded': True})
+_STARTING_BODY = orjson.dumps({'status': 'starting', 'model_loaded': False})
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint."""
+    if MODEL_READY:
+        return app.response_class(_HEALTHY_BODY, mimetype='application/json')
+    return app.response_class(_STARTING_BODY, status=503, mimetype='application/json')
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Semantic cache statistics."""
     bot = get_bot()
-    return jsonify({
-        'status': 'healthy',
-        'model_loaded': bot.is_loaded()
-    })
+    if bot.cache is None:
+        return jsonify({'cache_enabled': False})
+    return jsonify({'cache_enabled': True, 'cache': bot.cache.stats()})
+
+
+def validate_question(question: str) -> Optional[str]:
+    """Return an error message if the question is not acceptable."""
+    if not question:
+        return 'Question cannot be empty'
+    if len(question) > 2000:
+        return 'Question too long (max 2000 characters)'
+    return None
 
 
 @app.route('/chat', methods=['POST'])
@@ -43,11 +97,9 @@ def chat():
 
         # Validate input
         question = data.get('text', '').strip()
-        if not question:
-            return jsonify({'error': 'Question cannot be empty'}), 400
-
-        if len(question) > 2000:
-            return jsonify({'error': 'Question too long (max 2000 characters)'}), 400
+        error = validate_question(question)
+        if error:
+            return jsonify({'error': error}), 400
 
         # Get optional fields
         persona = data.get('persona', '').strip()
@@ -57,19 +109,20 @@ def chat():
         session_mgr = get_session_manager()
         session = session_mgr.get_or_create_session(session_id)
 
-        # Get conversation history
-        history = session.get_history_text()
+        with session.lock:
+            # Get conversation history
+            history = session.get_history_text()
 
-        # Generate response
-        bot = get_bot()
-        response = bot.generate_response(
-            question=question,
-            history=history,
-            persona=persona
-        )
+            # Generate response
+            bot = get_bot()
+            response = bot.generate_response(
+                question=question,
+                history=history,
+                persona=persona
+            )
 
-        # Save to history
-        session.add_exchange(question, response)
+            # Save to history
+            session.add_exchange(question, response)
 
         return jsonify({
             'prediction': response,
@@ -82,6 +135,90 @@ def chat():
         return jsonify({'error': 'Internal server error'}), 500
 
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Chat endpoint that streams the answer as Server-Sent Events."""
+    try:
+        data = request.get_json()
+
+        question = data.get('text', '').strip()
+        error = validate_question(question)
+        if error:
+            return jsonify({'error': error}), 400
+
+        persona = data.get('persona', '').strip()
+        session_mgr = get_session_manager()
+        session = session_mgr.get_or_create_session(data.get('session_id'))
+        bot = get_bot()
+
+    except Exception as e:
+        logger.error(f"Error in chat stream endpoint: {e}", exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
+
+    def events():
+        try:
+            with session.lock:
+                chunks = []
+                for chunk in bot.stream_response(question, session.get_history_text(), persona):
+                    chunks.append(chunk)
+                    yield sse_event({'token': chunk})
+
+                session.add_exchange(question, ''.join(chunks).strip())
+
+            yield sse_event({
+                'done': True,
+                'session_id': session.session_id,
+                'message_count': len(session.messages)
+            })
+
+        except Exception as e:
+            logger.error(f"Error streaming response: {e}", exc_info=True)
+            yield sse_event({'error': 'Internal server error'})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream')
+
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Answer several independent questions (no session history) at once."""
+    try:
+        data = request.get_json()
+
+        questions = data.get('questions')
+        if not isinstance(questions, list) or not questions:
+            return jsonify({'error': 'questions must be a non-empty list'}), 400
+
+        if len(questions) > config.MAX_BATCH_QUESTIONS:
+            return jsonify({'error': f'Too many questions (max {config.MAX_BATCH_QUESTIONS})'}), 400
+
+        if not all(isinstance(q, str) for q in questions):
+            return jsonify({'error': 'questions must be strings'}), 400
+
+        questions = [q.strip() for q in questions]
+        for question in questions:
+            error = validate_question(question)
+            if error:
+                return jsonify({'error': error}), 400
+
+        persona = data.get('persona', '').strip()
+
+        # Queue everything before waiting; the questions are answered in order
+        bot = get_bot()
+        futures = [bot.submit(question, persona=persona) for question in questions]
+        try:
+            predictions = [bot.wait(future) for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+        return jsonify({'predictions': predictions})
+
+    except Exception as e:
+        logger.error(f"Error in chat batch endpoint: {e}", exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
+
+
 @app.route('/session/clear', methods=['POST'])
 def clear_session():
     """Clear a session's conversation history."""
@@ -94,7 +231,8 @@ def clear_session():
 
         session_mgr = get_session_manager()
         session = session_mgr.get_or_create_session(session_id)
-        session.clear()
+        with session.lock:
+            session.clear()
 
         return jsonify({
             'success': True,
@@ -124,8 +262,14 @@ def cleanup_sessions():
         return jsonify({'error': 'Internal server error'}), 500
 
 
-def initialize_app():
-    """Initialize the application components."""
+def initialize_app(load_cache: bool = True):
+    """
+    Initialize the application components.
+
+    Pass load_cache=False to defer loading the semantic cache embedder,
+    e.g. to each forked Gunicorn worker.
+    """
+    global MODEL_READY
     logger.info("Initializing application...")
 
     # Initialize session manager
@@ -134,11 +278,13 @@ def initialize_app():
 
     # Initialize bot (this loads the model)
     logger.info("Loading LLM model... (this may take a few minutes on first run)")
-    init_bot(config)
+    init_bot(config, load_cache=load_cache)
+    MODEL_READY = True
     logger.info("Bot initialized successfully")
 
 
 if __name__ == '__main__':
+    # Development server only; production runs under gunicorn.conf.py
     initialize_app()
     logger.info(f"Starting server on {config.HOST}:{config.PORT}")
     app.run(
@@ -0,0 +1,96 @@
+"""
+Semantic cache for chatbot answers.
+Near-duplicate questions are answered from memory instead of running the LLM.
+"""
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """Embedding-based LRU cache of answers, namespaced by persona and history."""
+
+    def __init__(self, model_name: str, threshold: float = 0.93, max_entries: int = 1000,
+                 history_chars: int = 500):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.history_chars = history_chars
+        self.embedder = None
+
+        # Preallocated slots; the first `size` are in use
+        self.embeddings: Optional[np.ndarray] = None
+        self.answers: list = [None] * max_entries
+        self.namespaces: list = [None] * max_entries
+        self.last_used = np.zeros(max_entries, dtype=np.int64)
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the embedding model."""
+        # Imported here so torch is only needed when the cache is enabled
+        from sentence_transformers import SentenceTransformer
+
+        logger.info(f"Loading cache embedder: {self.model_name}")
+        self.embedder = SentenceTransformer(self.model_name)
+        dim = self.embedder.get_sentence_embedding_dimension()
+        self.embeddings = np.zeros((self.max_entries, dim), dtype=np.float32)
+
+    def namespace(self, persona: str = "", history: str = "") -> str:
+        """Key that cached answers must match exactly: the persona plus a hash of the conversation tail."""
+        tail = history[-self.history_chars:] if history and self.history_chars > 0 else ""
+        return f"{persona}\x00{hashlib.sha1(tail.encode()).hexdigest()}"
+
+    def embed(self, question: str) -> np.ndarray:
+        """Embed a question on its own, so history never truncates it away."""
+        return self.embedder.encode(question, normalize_embeddings=True).astype(np.float32)
+
+    def get(self, embedding: np.ndarray, namespace: str = "") -> Optional[str]:
+        """Return a cached answer if a similar enough question was seen."""
+        with self._lock:
+            if self.size:
+                # Embeddings are normalized, so the dot product is cosine similarity
+                scores = self.embeddings[:self.size] @ embedding
+                for idx in np.argsort(scores)[::-1]:
+                    if scores[idx] <= self.threshold:
+                        break
+                    if self.namespaces[idx] == namespace:
+                        self._touch(idx)
+                        self.hits += 1
+                        return self.answers[idx]
+            self.misses += 1
+            return None
+
+    def put(self, embedding: np.ndarray, namespace: str, answer: str):
+        """Store an answer, evicting the least recently used entry when full."""
+        with self._lock:
+            if self.size < self.max_entries:
+                idx = self.size
+                self.size += 1
+            else:
+                idx = int(np.argmin(self.last_used))
+            self.embeddings[idx] = embedding
+            self.answers[idx] = answer
+            self.namespaces[idx] = namespace
+            self._touch(idx)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters for monitoring."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': self.size,
+        }
+
+    def _touch(self, idx: int):
+        self._clock += 1
+        self.last_used[idx] = self._clock
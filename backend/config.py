@@ -14,6 +14,10 @@ class Config:
     PORT: int = int(os.getenv('PORT', 5000))
     DEBUG: bool = os.getenv('DEBUG', 'False').lower() == 'true'
 
+    # Gunicorn (production)
+    GUNICORN_WORKERS: int = int(os.getenv('GUNICORN_WORKERS', 2))
+    GUNICORN_THREADS: int = int(os.getenv('GUNICORN_THREADS', 4))
+
     # CORS
     CORS_ORIGINS: str = os.getenv('CORS_ORIGINS', '*')
 
@@ -21,13 +25,34 @@ class Config:
     SECRET_KEY: str = os.getenv('SECRET_KEY', 'change-this-in-production')
     SESSION_LIFETIME_HOURS: int = int(os.getenv('SESSION_LIFETIME_HOURS', 24))
     MAX_MESSAGES_PER_SESSION: int = int(os.getenv('MAX_MESSAGES_PER_SESSION', 50))
+    MAX_SESSIONS: int = int(os.getenv('MAX_SESSIONS', 10000))
 
     # LLM Model
     MODEL_NAME: str = os.getenv('MODEL_NAME', 'nouralmulhem/Llama-2-7b-finetune-q8')
-    MODEL_FILE: str = os.getenv('MODEL_FILE', 'model.bin')
+    # Unset serves the published q8 model.bin; a quantization produced by
+    # ml_pipeline/4_merge_and_convert.py is served from model-<quant>.gguf.
+    # q4_K_M halves the bytes read per token, roughly doubling CPU decode speed.
+    MODEL_QUANTIZATION: str = os.getenv('MODEL_QUANTIZATION', '')
+    MODEL_FILE: str = os.getenv(
+        'MODEL_FILE',
+        f'model-{MODEL_QUANTIZATION}.gguf' if MODEL_QUANTIZATION else 'model.bin'
+    )
+    MODEL_THREADS: int = int(os.getenv('MODEL_THREADS', -1))  # -1 = auto
+    MODEL_BATCH_SIZE: int = int(os.getenv('MODEL_BATCH_SIZE', 512))  # prompt tokens per eval step
     MAX_NEW_TOKENS: int = int(os.getenv('MAX_NEW_TOKENS', 512))
     TEMPERATURE: float = float(os.getenv('TEMPERATURE', 0.7))
 
+    # Generation
+    MAX_BATCH_QUESTIONS: int = int(os.getenv('MAX_BATCH_QUESTIONS', 8))  # per /chat/batch request
+    GENERATION_TIMEOUT: float = float(os.getenv('GENERATION_TIMEOUT', 300))
+
+    # Semantic cache
+    SEMANTIC_CACHE_ENABLED: bool = os.getenv('SEMANTIC_CACHE_ENABLED', 'True').lower() == 'true'
+    SEMANTIC_CACHE_MODEL: str = os.getenv('SEMANTIC_CACHE_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+    SEMANTIC_CACHE_THRESHOLD: float = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.93))
+    SEMANTIC_CACHE_MAX_ENTRIES: int = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', 1000))
+    SEMANTIC_CACHE_HISTORY_CHARS: int = int(os.getenv('SEMANTIC_CACHE_HISTORY_CHARS', 500))  # history tail that must match exactly
+
     # Logging
     LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
 
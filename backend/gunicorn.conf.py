@@ -0,0 +1,35 @@
+"""
+Gunicorn configuration for production.
+
+The app is initialized once in the master process (preload_app) and
+workers are forked from it, so the model weights are loaded a single time
+and shared copy-on-write. This relies on Gunicorn's default fork-based
+workers; anything that starts workers with `spawn` loads the model again.
+
+The semantic cache embedder runs on torch, whose OpenMP thread pools can
+deadlock in children forked after they start, so each worker loads its
+own copy after the fork instead.
+
+Usage:
+    gunicorn -c gunicorn.conf.py app:app
+"""
+from config import config
+
+bind = f"{config.HOST}:{config.PORT}"
+workers = config.GUNICORN_WORKERS
+worker_class = 'gthread'
+threads = config.GUNICORN_THREADS
+timeout = int(config.GENERATION_TIMEOUT)
+preload_app = True
+
+
+def on_starting(server):
+    """Load the model in the master before any worker is forked."""
+    from app import initialize_app
+    initialize_app(load_cache=False)
+
+
+def post_fork(server, worker):
+    """Load the semantic cache embedder in each worker."""
+    from models import get_bot
+    get_bot().load_cache()
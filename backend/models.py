@@ -3,23 +3,43 @@ Simple wrapper for the LLM model.
 Handles model loading and inference.
 """
 import logging
-from typing import Optional
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Iterator, Optional
 from langchain_community.llms import CTransformers
-from langchain_core.prompts import PromptTemplate
+
+from cache import SemanticCache
+from worker import GenerationWorker, TokenCallback
 
 logger = logging.getLogger(__name__)
 
+# Static system instructions that start every prompt. Keep this free of
+# variables: identical leading bytes across requests are what prompt/KV
+# prefix caches (llama-cpp-python cache_prompt=True, vLLM automatic prefix
+# caching) reuse. Dynamic parts are appended after it by build_prompt.
+SYSTEM_PREFIX = """[INST] <<SYS>>
+You are a helpful Jenkins expert. Answer questions about Jenkins clearly and concisely.
+"""
+
 
 class JenkinsBot:
     """Simple chatbot for Jenkins questions."""
 
-    def __init__(self, model_name: str, model_file: str, max_new_tokens: int = 512, temperature: float = 0.7):
+    def __init__(self, model_name: str, model_file: str, max_new_tokens: int = 512, temperature: float = 0.7,
+                 threads: int = -1, prompt_batch_size: int = 512, cache: Optional[SemanticCache] = None,
+                 generation_timeout: float = 300):
         self.model_name = model_name
         self.model_file = model_file
         self.max_new_tokens = max_new_tokens
         self.temperature = temperature
+        self.threads = threads
+        self.prompt_batch_size = prompt_batch_size
+        self.cache = cache
+        self.generation_timeout = generation_timeout
         self.llm = None
-        self.chain = None
+        # CTransformers is single-stream; only the worker thread touches it
+        self.worker = None
 
     def load(self):
         """Load the model."""
@@ -31,27 +51,15 @@ class JenkinsBot:
                 config={
                     'max_new_tokens': self.max_new_tokens,
                     'temperature': self.temperature,
+                    'threads': self.threads,
+                    'batch_size': self.prompt_batch_size,
+                    # Memory-mapped weights are shared between forked workers
+                    'mmap': True,
                 }
             )
 
-            # Create the prompt template
-            template = """[INST] <<SYS>>
-You are a helpful Jenkins expert. Answer questions about Jenkins clearly and concisely.
-{persona}
-
-Previous conversation:
-{history}
-<</SYS>>
-
-{question} [/INST]"""
-
-            prompt = PromptTemplate(
-                template=template,
-                input_variables=["question", "persona", "history"]
-            )
-
-            # Create the chain
-            self.chain = prompt | self.llm
+            # Generations, streamed or not, run one at a time on a worker thread
+            self.worker = GenerationWorker(self._generate)
 
             logger.info("Model loaded successfully")
             return True
@@ -60,42 +68,148 @@ Previous conversation:
             logger.error(f"Failed to load model: {e}")
             raise
 
-    def generate_response(self, question: str, history: str = "", persona: str = "") -> str:
-        """Generate a response to a question."""
-        if not self.chain:
+    def load_cache(self):
+        """Load the semantic cache's embedding model, if the cache is enabled."""
+        if self.cache is not None:
+            self.cache.load()
+
+    def build_prompt(self, question: str, history: str = "", persona: str = "") -> str:
+        """
+        Build the full prompt for a question.
+
+        Parts are ordered from least to most frequently changing (static
+        prefix, persona, history, question). History is append-only within
+        a session, so consecutive turns share everything up to the question.
+        """
+        return (
+            f"{SYSTEM_PREFIX}{persona}\n\n"
+            f"Previous conversation:\n{history}\n"
+            "<</SYS>>\n\n"
+            f"{question} [/INST]"
+        )
+
+    def _generate(self, prompt: str, on_token: Optional[TokenCallback] = None) -> str:
+        # The native ctransformers generator yields text as it is decoded;
+        # langchain's CTransformers has no _stream, so llm.stream() would not
+        chunks = []
+        for chunk in self.llm.client(prompt, stream=True):
+            chunks.append(chunk)
+            if on_token is not None and not on_token(chunk):
+                break
+        return ''.join(chunks).strip()
+
+    def submit(self, question: str, history: str = "", persona: str = "") -> Future:
+        """Queue a question for generation; the future resolves to the answer."""
+        if not self.llm:
             raise RuntimeError("Model not loaded. Call load() first.")
 
+        # Answer near-duplicate questions without running the LLM
+        if self.cache is not None:
+            embedding = self.cache.embed(question)
+            namespace = self.cache.namespace(persona, history)
+            cached = self.cache.get(embedding, namespace)
+            if cached is not None:
+                future = Future()
+                future.set_result(cached)
+                return future
+
+        future = self.worker.submit(self.build_prompt(question, history, persona))
+
+        if self.cache is not None:
+            def store(done: Future):
+                if not done.cancelled() and done.exception() is None:
+                    self.cache.put(embedding, namespace, done.result())
+            future.add_done_callback(store)
+
+        return future
+
+    def wait(self, future: Future) -> str:
+        """Wait for a submitted question, dropping it from the queue if it times out."""
         try:
-            response = self.chain.invoke({
-                "question": question,
-                "history": history,
-                "persona": persona
-            })
-            return response.strip()
+            return future.result(timeout=self.generation_timeout)
+        except Exception:
+            # An abandoned prompt must not hold up the worker later
+            future.cancel()
+            raise
 
+    def generate_response(self, question: str, history: str = "", persona: str = "") -> str:
+        """Generate a response to a question."""
+        try:
+            return self.wait(self.submit(question, history, persona))
         except Exception as e:
             logger.error(f"Error generating response: {e}")
             raise
 
+    def stream_response(self, question: str, history: str = "", persona: str = "") -> Iterator[str]:
+        """Generate a response to a question, yielding text as it is produced."""
+        if not self.llm:
+            raise RuntimeError("Model not loaded. Call load() first.")
+
+        if self.cache is not None:
+            embedding = self.cache.embed(question)
+            namespace = self.cache.namespace(persona, history)
+            cached = self.cache.get(embedding, namespace)
+            if cached is not None:
+                yield cached
+                return
+
+        # The worker hands tokens over through a queue, so a slow client
+        # never holds up the model
+        tokens: queue.Queue = queue.Queue()
+        closed = threading.Event()
+
+        def on_token(chunk: str) -> bool:
+            tokens.put(chunk)
+            return not closed.is_set()
+
+        future = self.worker.submit(self.build_prompt(question, history, persona), on_token)
+        future.add_done_callback(lambda _: tokens.put(None))
+        try:
+            while (chunk := tokens.get(timeout=self.generation_timeout)) is not None:
+                yield chunk
+        finally:
+            # Stops the generation early, or drops it from the queue, if the
+            # client went away or timed out
+            closed.set()
+            future.cancel()
+
+        answer = future.result()
+        if self.cache is not None:
+            self.cache.put(embedding, namespace, answer)
+
     def is_loaded(self) -> bool:
         """Check if model is loaded."""
-        return self.llm is not None and self.chain is not None
+        return self.llm is not None
 
 
 # Global bot instance
 bot: Optional[JenkinsBot] = None
 
 
-def init_bot(config):
+def init_bot(config, load_cache: bool = True):
     """Initialize the global bot instance."""
     global bot
+    cache = None
+    if config.SEMANTIC_CACHE_ENABLED:
+        cache = SemanticCache(
+            model_name=config.SEMANTIC_CACHE_MODEL,
+            threshold=config.SEMANTIC_CACHE_THRESHOLD,
+            max_entries=config.SEMANTIC_CACHE_MAX_ENTRIES,
+            history_chars=config.SEMANTIC_CACHE_HISTORY_CHARS
+        )
     bot = JenkinsBot(
         model_name=config.MODEL_NAME,
         model_file=config.MODEL_FILE,
         max_new_tokens=config.MAX_NEW_TOKENS,
-        temperature=config.TEMPERATURE
+        temperature=config.TEMPERATURE,
+        threads=config.MODEL_THREADS,
+        prompt_batch_size=config.MODEL_BATCH_SIZE,
+        cache=cache,
+        generation_timeout=config.GENERATION_TIMEOUT
     )
     bot.load()
+    if load_cache:
+        bot.load_cache()
 
 
 def get_bot() -> JenkinsBot:
@@ -2,8 +2,10 @@
 Simple session management for conversation history.
 Each user gets a session ID that tracks their conversation.
 """
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
+import threading
 import uuid
 
 
@@ -13,9 +15,13 @@ class ConversationSession:
     def __init__(self, session_id: str, max_messages: int = 50):
         self.session_id = session_id
         self.messages: List[Dict[str, str]] = []
+        # Append-only rendering of messages; earlier turns keep identical bytes
+        self.history_text = ""
         self.created_at = datetime.now()
         self.last_used = datetime.now()
         self.max_messages = max_messages
+        # Held for a whole turn so concurrent requests see consistent history
+        self.lock = threading.Lock()
 
     def add_exchange(self, human_msg: str, ai_msg: str):
         """Add a question-answer exchange."""
@@ -26,55 +32,75 @@ class ConversationSession:
         })
         self.last_used = datetime.now()
 
-        # Keep only recent messages
-        if len(self.messages) > self.max_messages:
-            self.messages = self.messages[-self.max_messages:]
+        self.history_text += self._format_exchange(self.messages[-1])
+
+        # Keep only recent messages, cutting the oldest exchange off the front
+        # of the history text instead of re-rendering every message
+        while len(self.messages) > self.max_messages:
+            oldest = self.messages.pop(0)
+            self.history_text = self.history_text[len(self._format_exchange(oldest)):]
+
+    @staticmethod
+    def _format_exchange(msg: Dict[str, str]) -> str:
+        return f"Human: {msg['human']}\nAI: {msg['ai']}\n"
 
     def get_history_text(self) -> str:
         """Get conversation history as text for LLM context."""
-        history_lines = []
-        for msg in self.messages:
-            history_lines.append(f"Human: {msg['human']}")
-            history_lines.append(f"AI: {msg['ai']}")
-        return '\n'.join(history_lines)
+        return self.history_text
 
     def clear(self):
         """Clear all messages."""
         self.messages = []
+        self.history_text = ""
         self.last_used = datetime.now()
 
 
 class SessionManager:
     """Manages all conversation sessions."""
 
-    def __init__(self, session_lifetime_hours: int = 24, max_messages: int = 50):
-        self.sessions: Dict[str, ConversationSession] = {}
+    def __init__(self, session_lifetime_hours: int = 24, max_messages: int = 50, max_sessions: int = 10000):
+        # Ordered from least to most recently used
+        self.sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()
         self.session_lifetime = timedelta(hours=session_lifetime_hours)
         self.max_messages = max_messages
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
 
     def get_or_create_session(self, session_id: Optional[str] = None) -> ConversationSession:
         """Get existing session or create a new one."""
-        if session_id and session_id in self.sessions:
-            session = self.sessions[session_id]
-            session.last_used = datetime.now()
+        with self._lock:
+            if session_id and session_id in self.sessions:
+                session = self.sessions[session_id]
+                session.last_used = datetime.now()
+                self.sessions.move_to_end(session_id)
+                return session
+
+            # Make room before creating a new session
+            self._remove_expired()
+            while len(self.sessions) >= self.max_sessions:
+                self.sessions.popitem(last=False)
+
+            new_id = session_id if session_id else str(uuid.uuid4())
+            session = ConversationSession(new_id, self.max_messages)
+            self.sessions[new_id] = session
             return session
 
-        # Create new session
-        new_id = session_id if session_id else str(uuid.uuid4())
-        session = ConversationSession(new_id, self.max_messages)
-        self.sessions[new_id] = session
-        return session
-
     def cleanup_old_sessions(self):
         """Remove sessions that haven't been used recently."""
+        with self._lock:
+            return self._remove_expired()
+
+    def _remove_expired(self) -> int:
+        # Only the least recently used end can be expired
         now = datetime.now()
-        expired = [
-            sid for sid, session in self.sessions.items()
-            if now - session.last_used > self.session_lifetime
-        ]
-        for sid in expired:
-            del self.sessions[sid]
-        return len(expired)
+        removed = 0
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.last_used <= self.session_lifetime:
+                break
+            self.sessions.popitem(last=False)
+            removed += 1
+        return removed
 
 
 # Global session manager
@@ -86,7 +112,8 @@ def init_session_manager(config):
     global session_manager
     session_manager = SessionManager(
         session_lifetime_hours=config.SESSION_LIFETIME_HOURS,
-        max_messages=config.MAX_MESSAGES_PER_SESSION
+        max_messages=config.MAX_MESSAGES_PER_SESSION,
+        max_sessions=config.MAX_SESSIONS
     )
 
 
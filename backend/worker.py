@@ -0,0 +1,54 @@
+"""
+Serialized LLM generation.
+The model runs one generation at a time, so requests (streamed or not) are
+queued and handed to a single worker thread in arrival order.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+# Receives each generated chunk; returning False stops the generation
+TokenCallback = Callable[[str], bool]
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationWorker:
+    """Runs prompts from request threads one at a time on a worker thread."""
+
+    def __init__(self, generate: Callable[[str, Optional[TokenCallback]], str]):
+        self.generate = generate
+        self._queue: queue.Queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, prompt: str, on_token: Optional[TokenCallback] = None) -> Future:
+        """Queue a prompt; the returned future resolves to the generated text."""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((prompt, on_token, future))
+        return future
+
+    def _ensure_worker(self):
+        """Start the worker thread on first use."""
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='llm-worker', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            prompt, on_token, future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            # Each future resolves as soon as its own generation finishes
+            try:
+                future.set_result(self.generate(prompt, on_token))
+            except Exception as e:
+                logger.error(f"Generation failed: {e}")
+                future.set_exception(e)
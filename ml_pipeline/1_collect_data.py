@@ -3,13 +3,17 @@ Step 1: Collect training data from various sources.
 Simple, clean data collection for Jenkins Q&A pairs.
 """
 import os
-import csv
-import requests
+import argparse
+import asyncio
+import aiohttp
+import orjson
 from bs4 import BeautifulSoup
-from typing import List, Dict
+from typing import List, Dict, Optional
 import time
 import yaml
 from pathlib import Path
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 # Load config
 with open('config.yaml', 'r') as f:
@@ -18,24 +22,25 @@ with open('config.yaml', 'r') as f:
 OUTPUT_DIR = Path(config['paths']['raw_data'])
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+STACKEXCHANGE_API = "https://api.stackexchange.com/2.3"
 
-def collect_from_csv(csv_path: str) -> List[Dict[str, str]]:
-    """Load existing CSV data."""
-    data = []
+
+def collect_from_csv(csv_path: str) -> Optional[pa.Table]:
+    """Load existing CSV data as an Arrow table."""
     if not os.path.exists(csv_path):
         print(f"CSV file not found: {csv_path}")
-        return data
+        return None
 
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            data.append(row)
+    table = pa_csv.read_csv(
+        csv_path,
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True)
+    )
 
-    print(f"Loaded {len(data)} rows from {csv_path}")
-    return data
+    print(f"Loaded {table.num_rows} rows from {csv_path}")
+    return table
 
 
-def scrape_jenkins_docs_qa(max_pages: int = 50) -> List[Dict[str, str]]:
+def scrape_jenkins_docs_qa(max_pages: int = 50) -> pa.Table:
     """
     Scrape Jenkins documentation to create Q&A pairs.
     This is a simple example - expand based on actual doc structure.
@@ -47,46 +52,140 @@ def scrape_jenkins_docs_qa(max_pages: int = 50) -> List[Dict[str, str]]:
     # In production, you'd iterate through documentation pages
     # For now, this is a placeholder showing the structure
 
-    return qa_pairs
+    return pa.Table.from_pylist(qa_pairs)
+
+
+class _Backoff:
+    """Earliest time the next Stack Exchange call may be sent, shared by all calls."""
+
+    def __init__(self):
+        self.not_before = 0.0
+
+    async def wait(self):
+        # Loop in case another response pushed the deadline out while sleeping
+        while (delay := self.not_before - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def extend(self, seconds: float):
+        self.not_before = max(self.not_before, time.monotonic() + seconds)
+
+
+async def _fetch_stackexchange(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    backoff: _Backoff,
+    path: str,
+    params: Dict[str, str]
+) -> Dict:
+    """GET one Stack Exchange API endpoint, honoring its backoff field."""
+    async with semaphore:
+        await backoff.wait()
+        async with session.get(f"{STACKEXCHANGE_API}/{path}", params=params) as response:
+            response.raise_for_status()
+            data = orjson.loads(await response.read())
+        # The API asks clients to wait `backoff` seconds before calling again;
+        # every pending request waits, not just this one
+        if data.get('backoff'):
+            backoff.extend(data['backoff'])
+    return data
 
 
-def scrape_stackoverflow(tag: str = "jenkins", max_pages: int = 10) -> List[Dict[str, str]]:
+async def scrape_stackoverflow_async(
+    tag: str = "jenkins",
+    max_pages: int = 10,
+    max_concurrency: int = 10
+) -> List[Dict[str, str]]:
+    """Fetch question/accepted-answer pairs for a tag with concurrent API calls."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    backoff = _Backoff()
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Question pages are independent, so request them all at once
+        pages = await asyncio.gather(*[
+            _fetch_stackexchange(session, semaphore, backoff, "questions", {
+                'tagged': tag,
+                'site': 'stackoverflow',
+                'sort': 'votes',
+                'filter': 'withbody',
+                'pagesize': '100',
+                'page': str(page),
+            })
+            for page in range(1, max_pages + 1)
+        ])
+
+        questions = {
+            item['accepted_answer_id']: item
+            for page in pages
+            for item in page.get('items', [])
+            if 'accepted_answer_id' in item
+        }
+
+        # The answers endpoint takes up to 100 ids per call
+        answer_ids = [str(answer_id) for answer_id in questions]
+        batches = await asyncio.gather(*[
+            _fetch_stackexchange(session, semaphore, backoff, f"answers/{';'.join(answer_ids[i:i + 100])}", {
+                'site': 'stackoverflow',
+                'filter': 'withbody',
+                'pagesize': '100',
+            })
+            for i in range(0, len(answer_ids), 100)
+        ])
+
+    return [
+        {
+            'Question Body': questions[answer['answer_id']]['body'],
+            'Answer Body': answer['body'],
+        }
+        for batch in batches
+        for answer in batch.get('items', [])
+        if answer['answer_id'] in questions
+    ]
+
+
+def scrape_stackoverflow(tag: str = "jenkins", max_pages: int = 10) -> pa.Table:
     """
     Scrape Stack Overflow questions with Jenkins tag.
-    Note: Respect Stack Overflow's API rate limits and terms of service.
-    Consider using their official API instead.
+    Uses the official Stack Exchange API; respect its rate limits and terms of service.
     """
-    qa_pairs = []
     print(f"Scraping Stack Overflow (tag: {tag})...")
 
-    # Placeholder - in production, use Stack Overflow API
-    # https://api.stackexchange.com/docs
-
-    print("Note: Use Stack Overflow API for production scraping")
-    print("Example: https://api.stackexchange.com/2.3/questions?tagged=jenkins")
+    qa_pairs = asyncio.run(scrape_stackoverflow_async(tag, max_pages))
 
-    return qa_pairs
+    print(f"Collected {len(qa_pairs)} Q&A pairs")
+    return pa.Table.from_pylist(qa_pairs)
 
 
-def save_to_csv(data: List[Dict[str, str]], filename: str):
+def save_to_csv(table: Optional[pa.Table], filename: str, output_dir: Path = OUTPUT_DIR):
     """Save collected data to CSV."""
-    if not data:
+    if table is None or table.num_rows == 0:
         print(f"No data to save for {filename}")
         return
 
-    output_path = OUTPUT_DIR / filename
-    fieldnames = list(data[0].keys())
+    output_path = output_dir / filename
+    pa_csv.write_csv(table, output_path)
 
-    with open(output_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(data)
+    print(f"Saved {table.num_rows} rows to {output_path}")
 
-    print(f"Saved {len(data)} rows to {output_path}")
+
+def collect_stackoverflow(output_dir: Path):
+    """Fetch Stack Overflow Q&A and save it where 2_preprocess_data.py reads it."""
+    max_pages = next(
+        (source.get('max_pages', 10) for source in config['data_sources'] if source['name'] == 'stackoverflow'),
+        10
+    )
+    output_dir.mkdir(parents=True, exist_ok=True)
+    save_to_csv(scrape_stackoverflow(max_pages=max_pages), "QueryResultsUpdated.csv", output_dir)
 
 
 def main():
     """Main data collection pipeline."""
+    parser = argparse.ArgumentParser(description='Collect Jenkins Q&A data')
+    parser.add_argument('--scrape', action='store_true',
+                        help='Fetch Stack Overflow Q&A even if datasets exist '
+                             '(overwrites ../datasets/QueryResultsUpdated.csv)')
+    args = parser.parse_args()
+
     print("=" * 60)
     print("Jenkins Chatbot - Data Collection")
     print("=" * 60)
@@ -94,6 +193,10 @@ def main():
     # Check if we already have data in datasets/
     existing_data_path = Path("../datasets")
 
+    if args.scrape:
+        collect_stackoverflow(existing_data_path)
+        return
+
     if existing_data_path.exists():
         print("\nFound existing datasets directory.")
         print("Using existing data files:")
@@ -104,35 +207,30 @@ def main():
         query_results = existing_data_path / "QueryResultsUpdated.csv"
         if query_results.exists():
             datasets['query_results'] = collect_from_csv(str(query_results))
-            print(f"  ✓ QueryResultsUpdated.csv: {len(datasets['query_results'])} rows")
+            print(f"  ✓ QueryResultsUpdated.csv: {datasets['query_results'].num_rows} rows")
 
         jenkins_docs = existing_data_path / "Jenkins Docs QA.csv"
         if jenkins_docs.exists():
             datasets['jenkins_docs'] = collect_from_csv(str(jenkins_docs))
-            print(f"  ✓ Jenkins Docs QA.csv: {len(datasets['jenkins_docs'])} rows")
+            print(f"  ✓ Jenkins Docs QA.csv: {datasets['jenkins_docs'].num_rows} rows")
 
         community_qs = existing_data_path / "Community Questions Refined.csv"
         if community_qs.exists():
             datasets['community'] = collect_from_csv(str(community_qs))
-            print(f"  ✓ Community Questions Refined.csv: {len(datasets['community'])} rows")
+            print(f"  ✓ Community Questions Refined.csv: {datasets['community'].num_rows} rows")
 
         if datasets:
-            print(f"\nTotal available data: {sum(len(d) for d in datasets.values())} rows")
+            print(f"\nTotal available data: {sum(t.num_rows for t in datasets.values())} rows")
             print("\nData collection complete! Using existing datasets.")
-            print("If you want to collect new data, implement the scraping functions.")
+            print("Run with --scrape to fetch fresh Stack Overflow Q&A.")
             return
 
-    print("\nNo existing data found.")
-    print("\nTo collect data, you can:")
-    print("1. Add CSV files to ../datasets/")
-    print("2. Implement web scraping functions in this script")
-    print("3. Use the Jenkins API and Stack Overflow API")
-
-    print("\nRecommended data sources:")
-    print("  - Jenkins official documentation")
-    print("  - Jenkins community forums")
-    print("  - Stack Overflow (jenkins tag)")
-    print("  - GitHub issues from Jenkins repos")
+    print("\nNo existing data found. Fetching Stack Overflow Q&A (jenkins tag)...")
+    collect_stackoverflow(existing_data_path)
+
+    print("\nOther data sources can be added as CSV files in ../datasets/:")
+    print("  - Jenkins Docs QA.csv (Question, Answer)")
+    print("  - Community Questions Refined.csv (questions, answers)")
 
 
 if __name__ == "__main__":
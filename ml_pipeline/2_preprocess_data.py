@@ -1,14 +1,37 @@
 """
 Step 2: Preprocess and prepare data for training.
 Clean, format, and merge all data sources into training format.
+
+Usage:
+    python 2_preprocess_data.py [--workers 3] [--pretokenize]
 """
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import yaml
 from pathlib import Path
-from bs4 import BeautifulSoup
-from typing import List, Dict
+from lxml import etree
+from lxml import html as lxml_html
+from typing import List
 import re
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    import hyperscan
+    HAS_HYPERSCAN = True
+except ImportError:
+    HAS_HYPERSCAN = False
+
 # Load config
 with open('config.yaml', 'r') as f:
     config = yaml.safe_load(f)
@@ -24,31 +47,182 @@ REMOVE_CODE = config['preprocessing']['remove_code_blocks']
 MIN_ANSWER_LEN = config['preprocessing']['min_answer_length']
 MAX_ANSWER_LEN = config['preprocessing']['max_answer_length']
 
+# Output shards
+ROWS_PER_SHARD = 50000
+ROWS_PER_GROUP = 10000
+
+# Text cleaning patterns, compiled once
+_WS_RE = re.compile(r'\s+')
+_PUNCT_RE = re.compile(r'[^\w\s.,!?-]')
+
+# Shared HTML parser (lxml, C extension)
+_HTML_PARSER = lxml_html.HTMLParser(remove_blank_text=True)
+_TAG_RE = re.compile(r'<[^>]+>')
+
+# Code block markers, matched case-insensitively
+_CODE_MARKERS = [b'<code>', b'```']
+_CODE_RE = re.compile(b'|'.join(re.escape(m) for m in _CODE_MARKERS), re.IGNORECASE)
+
+if HAS_HYPERSCAN:
+    _CODE_DB = hyperscan.Database()
+    _CODE_DB.compile(
+        expressions=_CODE_MARKERS,
+        ids=list(range(len(_CODE_MARKERS))),
+        elements=len(_CODE_MARKERS),
+        flags=[hyperscan.HS_FLAG_CASELESS] * len(_CODE_MARKERS),
+    )
+
 
 def clean_html(text: str) -> str:
     """Remove HTML tags from text."""
     if pd.isna(text):
         return ""
-    soup = BeautifulSoup(str(text), 'html.parser')
-    # Remove code blocks if configured
-    if REMOVE_CODE:
-        for code_tag in soup.find_all('code'):
-            code_tag.decompose()
-    return soup.get_text(separator=' ', strip=True)
-
-
-def clean_text(text: str) -> str:
-    """Clean and normalize text."""
-    # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text)
-    # Remove special characters but keep basic punctuation
-    text = re.sub(r'[^\w\s.,!?-]', '', text)
-    return text.strip()
+    text = str(text)
+    # Most rows are plain text; only parse when there is markup or an entity
+    if '<' not in text and '&' not in text:
+        return text.strip()
+    try:
+        root = lxml_html.fragment_fromstring(text, create_parent='div', parser=_HTML_PARSER)
+    except (ValueError, etree.ParserError):
+        return _TAG_RE.sub(' ', text).strip()
+    # Empty non-content elements, and code blocks if configured; the text
+    # after them stays a separate piece
+    drop_tags = ['script', 'style'] + (['code'] if REMOVE_CODE else [])
+    for element in list(root.iter(*drop_tags)):
+        element.clear(keep_tail=True)
+    pieces = (piece.strip() for piece in root.itertext())
+    return ' '.join(piece for piece in pieces if piece)
+
+
+if HAS_NUMBA:
+    # Serial on purpose: datasets are processed in forked worker processes,
+    # and Numba's parallel thread pool does not survive fork
+    @njit(cache=True)
+    def _length_mask(lengths, min_len, max_len):
+        mask = np.empty(lengths.shape[0], dtype=np.bool_)
+        for i in range(lengths.shape[0]):
+            mask[i] = min_len <= lengths[i] <= max_len
+        return mask
+
+    @njit(cache=True)
+    def _whitespace_width(buf, i, n):
+        """Byte width of the UTF-8 whitespace character at buf[i], or 0."""
+        b = buf[i]
+        if b == 32 or 9 <= b <= 13 or 28 <= b <= 31:
+            return 1
+        if b == 0xC2 and i + 1 < n and (buf[i + 1] == 0x85 or buf[i + 1] == 0xA0):
+            return 2
+        if i + 2 < n:
+            b1 = buf[i + 1]
+            b2 = buf[i + 2]
+            if b == 0xE1 and b1 == 0x9A and b2 == 0x80:
+                return 3
+            if b == 0xE2 and b1 == 0x80 and (b2 <= 0x8A or b2 == 0xA8 or b2 == 0xA9 or b2 == 0xAF):
+                return 3
+            if b == 0xE2 and b1 == 0x81 and b2 == 0x9F:
+                return 3
+            if b == 0xE3 and b1 == 0x80 and b2 == 0x80:
+                return 3
+        return 0
+
+    @njit(cache=True)
+    def _collapse_whitespace(buf, out):
+        """Copy UTF-8 bytes into out with each whitespace run replaced by one space."""
+        n = buf.shape[0]
+        i = 0
+        j = 0
+        in_space = False
+        while i < n:
+            width = _whitespace_width(buf, i, n)
+            if width:
+                if not in_space:
+                    out[j] = 32
+                    j += 1
+                    in_space = True
+                i += width
+            else:
+                # NUL separates rows, so whitespace runs never span two rows
+                out[j] = buf[i]
+                j += 1
+                in_space = False
+                i += 1
+        return j
+
+
+def warmup():
+    """Compile (or load cached) Numba kernels so the first real call is fast."""
+    if HAS_NUMBA:
+        _length_mask(np.zeros(1, dtype=np.int64), 0, 1)
+        sample = np.frombuffer(b' a\x00b ', dtype=np.uint8)
+        _collapse_whitespace(sample, np.empty_like(sample))
+
+
+warmup()
+
+
+def length_mask(lengths: pd.Series, min_len: int, max_len: int) -> np.ndarray:
+    """Boolean mask of min_len <= length <= max_len."""
+    values = lengths.to_numpy(dtype=np.int64)
+    if HAS_NUMBA:
+        return _length_mask(values, min_len, max_len)
+    return (values >= min_len) & (values <= max_len)
+
+
+def normalize_whitespace(series: pd.Series) -> pd.Series:
+    """Collapse whitespace runs in every string of a column to single spaces."""
+    if not HAS_NUMBA or series.empty:
+        return series.str.replace(_WS_RE, ' ', regex=True)
+
+    # One UTF-8 buffer for the whole column, rows separated by NUL
+    joined = '\x00'.join(series.str.replace('\x00', '', regex=False)).encode('utf-8')
+    buf = np.frombuffer(joined, dtype=np.uint8)
+    out = np.empty_like(buf)
+    size = _collapse_whitespace(buf, out)
+    return pd.Series(out[:size].tobytes().decode('utf-8').split('\x00'), index=series.index)
+
+
+def clean_text_column(series: pd.Series) -> pd.Series:
+    """Clean and normalize a column of text."""
+    # Collapse whitespace runs to one space, then remove special characters
+    # but keep basic punctuation
+    return normalize_whitespace(series).str.replace(_PUNCT_RE, '', regex=True).str.strip()
+
+
+def contains_code(series: pd.Series) -> np.ndarray:
+    """Boolean mask of rows containing a code marker, from one scan of the column."""
+    encoded = [text.encode('utf-8') for text in series.fillna('')]
+    # Rows are joined with NUL; row i ends before row_ends[i]
+    row_ends = np.cumsum([len(data) + 1 for data in encoded])
+    joined = b'\x00'.join(encoded)
+
+    if HAS_HYPERSCAN:
+        positions = []
+
+        def on_match(pattern_id, start, end, flags, context):
+            positions.append(end - 1)
+
+        _CODE_DB.scan(joined, match_event_handler=on_match)
+    else:
+        positions = [match.start() for match in _CODE_RE.finditer(joined)]
+
+    mask = np.zeros(len(encoded), dtype=bool)
+    mask[np.searchsorted(row_ends, positions, side='right')] = True
+    return mask
+
+
+# Llama-2 instruction format
+INSTRUCTION_TEMPLATE = "<s>[INST] {question} [/INST] {answer} </s>"
+
+# Literal pieces of the template, for building whole columns at once
+_INSTRUCTION_PREFIX, _INSTRUCTION_MIDDLE, _INSTRUCTION_SUFFIX = re.split(r"\{question\}|\{answer\}", INSTRUCTION_TEMPLATE)
+
+# Characters the instruction template adds around the question and answer
+_INSTRUCTION_OVERHEAD = len(_INSTRUCTION_PREFIX + _INSTRUCTION_MIDDLE + _INSTRUCTION_SUFFIX)
 
 
 def format_as_instruction(question: str, answer: str) -> str:
     """Format Q&A pair in Llama-2 instruction format."""
-    return f"<s>[INST] {question.strip()} [/INST] {answer.strip()} </s>"
+    return INSTRUCTION_TEMPLATE.format(question=question.strip(), answer=answer.strip())
 
 
 def load_and_process_dataset(
@@ -73,62 +247,120 @@ def load_and_process_dataset(
         print(f"  ✗ File not found: {file_path}")
         return pd.DataFrame()
 
-    # Load data
-    df = pd.read_csv(file_path)
-    print(f"  Loaded {len(df)} rows")
-
-    # Check if columns exist
-    if question_col not in df.columns or answer_col not in df.columns:
+    # Load only the two columns we need with Arrow's multithreaded parser;
+    # Arrow-backed strings avoid materializing a Python object per cell
+    try:
+        table = pa_csv.read_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(use_threads=True),
+            parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=[question_col, answer_col],
+                column_types={question_col: pa.string(), answer_col: pa.string()},
+            ),
+        )
+    except KeyError:
         print(f"  ✗ Required columns not found: {question_col}, {answer_col}")
         return pd.DataFrame()
 
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    print(f"  Loaded {len(df)} rows")
+
     # Clean HTML
     df['question_clean'] = df[question_col].apply(clean_html)
     df['answer_clean'] = df[answer_col].apply(clean_html)
 
     # Filter out empty entries
+    no_limit = np.iinfo(np.int64).max
+    question_lengths = df['question_clean'].str.len()
+    answer_lengths = df['answer_clean'].str.len()
     df = df[
-        (df['question_clean'].str.len() > 10) &
-        (df['answer_clean'].str.len() >= MIN_ANSWER_LEN)
+        length_mask(question_lengths, 11, no_limit) &
+        length_mask(answer_lengths, MIN_ANSWER_LEN, no_limit)
     ]
     print(f"  After removing empty entries: {len(df)} rows")
 
     # Filter by answer length
-    df = df[df['answer_clean'].str.len() <= MAX_ANSWER_LEN]
+    df = df[length_mask(df['answer_clean'].str.len(), 0, MAX_ANSWER_LEN)]
     print(f"  After answer length filter: {len(df)} rows")
 
     # Check for code blocks if configured
     if REMOVE_CODE:
-        df = df[
-            ~df['question_clean'].str.contains('<code>|```', case=False, na=False) &
-            ~df['answer_clean'].str.contains('<code>|```', case=False, na=False)
-        ]
+        df = df[~(contains_code(df['question_clean']) | contains_code(df['answer_clean']))]
         print(f"  After removing code blocks: {len(df)} rows")
 
     # Clean text
-    df['question_clean'] = df['question_clean'].apply(clean_text)
-    df['answer_clean'] = df['answer_clean'].apply(clean_text)
+    df['question_clean'] = clean_text_column(df['question_clean'])
+    df['answer_clean'] = clean_text_column(df['answer_clean'])
 
-    # Format as instructions
-    df['text'] = df.apply(
-        lambda row: format_as_instruction(
-            row['question_clean'],
-            row['answer_clean']
-        ),
-        axis=1
+    # Filter by total sequence length before paying for the concatenation
+    df['text_length'] = (
+        df['question_clean'].str.len() + df['answer_clean'].str.len() + _INSTRUCTION_OVERHEAD
     )
-
-    # Filter by total sequence length
-    df['text_length'] = df['text'].str.len()
-    df = df[df['text_length'] <= MAX_SEQ_LENGTH]
+    df = df[length_mask(df['text_length'], 0, MAX_SEQ_LENGTH)]
     print(f"  After sequence length filter: {len(df)} rows")
 
+    # Format as instructions
+    df['text'] = (
+        _INSTRUCTION_PREFIX + df['question_clean'] +
+        _INSTRUCTION_MIDDLE + df['answer_clean'] + _INSTRUCTION_SUFFIX
+    )
+
     # Return only the text column
     return df[['text', 'text_length']]
 
 
+def pretokenize(texts: List[str]) -> pa.Array:
+    """Tokenize texts with the base model's tokenizer into an int32 list column."""
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(config['training']['base_model'], use_fast=True)
+    if not tokenizer.is_fast:
+        raise ValueError(f"No fast (Rust) tokenizer available for {config['training']['base_model']}")
+    input_ids = tokenizer(
+        texts,
+        truncation=True,
+        max_length=config['training']['max_seq_length'],
+        add_special_tokens=False,
+        padding=False,
+        return_tensors=None,
+    )['input_ids']
+    return pa.array(input_ids, type=pa.large_list(pa.int32()))
+
+
+def save_training_data(df: pd.DataFrame, output_dir: Path, tokenize: bool = False):
+    """Write the training set as zstd-compressed Parquet shards."""
+    table = pa.Table.from_pandas(df[['text']], preserve_index=False)
+    if tokenize:
+        print("Pre-tokenizing training data...")
+        table = table.append_column('input_ids', pretokenize(df['text'].tolist()))
+        # Training only reuses input_ids produced with the same settings
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            'tokenizer': config['training']['base_model'],
+            'max_seq_length': str(config['training']['max_seq_length']),
+        })
+
+    pq.write_to_dataset(
+        table,
+        root_path=output_dir,
+        compression='zstd',
+        row_group_size=ROWS_PER_GROUP,
+        max_rows_per_file=ROWS_PER_SHARD,
+        basename_template='part-{i}.parquet',
+        existing_data_behavior='delete_matching',
+    )
+
+
 def main():
     """Main preprocessing pipeline."""
+    parser = argparse.ArgumentParser(description='Preprocess Jenkins Q&A data for training')
+    parser.add_argument('--workers', type=int, default=min(3, os.cpu_count() or 1),
+                        help='Number of datasets to process in parallel')
+    parser.add_argument('--pretokenize', action='store_true',
+                        help='Also store input_ids from the base model tokenizer')
+    args = parser.parse_args()
+
     print("=" * 60)
     print("Jenkins Chatbot - Data Preprocessing")
     print("=" * 60)
@@ -160,17 +392,25 @@ def main():
         }
     ]
 
-    # Process each dataset
-    processed_dfs = []
-    for dataset_info in datasets_to_process:
-        df = load_and_process_dataset(
-            dataset_info['file'],
-            dataset_info['question_col'],
-            dataset_info['answer_col']
-        )
-        if not df.empty:
-            processed_dfs.append(df)
-            print(f"  ✓ {dataset_info['name']}: {len(df)} examples")
+    # Process datasets in parallel; they share no state
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [
+            executor.submit(
+                load_and_process_dataset,
+                dataset_info['file'],
+                dataset_info['question_col'],
+                dataset_info['answer_col']
+            )
+            for dataset_info in datasets_to_process
+        ]
+
+        # Collect in the original order so the merged shuffle is reproducible
+        processed_dfs = []
+        for dataset_info, future in zip(datasets_to_process, futures):
+            df = future.result()
+            if not df.empty:
+                processed_dfs.append(df)
+                print(f"  ✓ {dataset_info['name']}: {len(df)} examples")
 
     if not processed_dfs:
         print("\n✗ No data processed! Check your data files.")
@@ -185,9 +425,9 @@ def main():
     final_df = final_df.sample(frac=1, random_state=42).reset_index(drop=True)
 
     # Save training data
-    output_file = OUTPUT_DIR / 'training_data.csv'
-    final_df[['text']].to_csv(output_file, index=False)
-    print(f"\n✓ Saved training data to: {output_file}")
+    output_dir = OUTPUT_DIR / 'training_data'
+    save_training_data(final_df, output_dir, tokenize=args.pretokenize)
+    print(f"\n✓ Saved training data to: {output_dir}")
 
     # Print statistics
     print("\n" + "=" * 60)
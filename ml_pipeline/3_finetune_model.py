@@ -8,125 +8,429 @@ This script can run on:
 - Cloud GPU instances
 
 Usage:
-    python 3_finetune_model.py [--local] [--epochs 5] [--batch_size 4]
+    python 3_finetune_model.py [--local] [--epochs 5] [--batch_size 4] [--grad_accum 8] [--streaming]
+
+Effective batch size = batch_size * grad_accum * number of GPUs.
+
+Multi-GPU (one full model replica per GPU, data parallel):
+    torchrun --nproc_per_node=N 3_finetune_model.py --local
+
+On Ampere or newer GPUs, install flash-attn (pip install flash-attn>=2.5)
+to train with FlashAttention-2; otherwise PyTorch SDPA attention is used.
+
+If unsloth is installed (pip install unsloth), its fused Llama kernels are
+used for loading and LoRA; pass --no_unsloth to train with plain HF/PEFT.
+
+Llama-2 base models with a pre-quantized 4-bit mirror on the Hub are loaded
+from the mirror; pass --no_prequantized to download and quantize the
+original fp16 weights instead.
 """
 import os
 import argparse
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import shutil
 from pathlib import Path
+import math
 import yaml
-import torch
-from datasets import load_dataset
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    BitsAndBytesConfig,
-    TrainingArguments,
-)
-from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
-from trl import SFTTrainer
+from packaging import version
+
+# torch, datasets, transformers, peft and trl are imported inside the
+# functions that use them, so --help and argument errors return instantly
 
 # Load config
 with open('config.yaml', 'r') as f:
     config = yaml.safe_load(f)
 
+# Every linear projection in a Llama decoder block
+LLAMA_LINEAR_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+
+# Hub mirrors of the base models already quantized to NF4 with double quantization
+PREQUANTIZED_MODELS = {
+    "meta-llama/Llama-2-7b-hf": "unsloth/llama-2-7b-bnb-4bit",
+    "meta-llama/Llama-2-7b-chat-hf": "unsloth/llama-2-7b-chat-bnb-4bit",
+}
+
+# Quantized base models reused across runs
+QUANTIZED_CACHE_DIR = Path.home() / ".cache" / "jenkins-ai" / "quantized"
+
+# Non-reentrant checkpointing composes with FlashAttention-2 and DDP
+GRADIENT_CHECKPOINTING_KWARGS = {"use_reentrant": False}
+
 
 def setup_paths(local_mode=True):
     """Setup paths for local or Colab environment."""
     if local_mode:
         return {
-            'data': Path(config['paths']['training_data']) / 'training_data.csv',
+            'data': Path(config['paths']['training_data']) / 'training_data',
             'output': Path(config['paths']['models']) / config['training']['output_model_name'],
             'logs': Path(config['paths']['logs'])
         }
     else:
         # Colab paths with Google Drive
         return {
-            'data': Path('/content/Enhancing-LLM-with-Jenkins-Knowledge/datasets/training/training_data.csv'),
+            'data': Path('/content/Enhancing-LLM-with-Jenkins-Knowledge/datasets/training/training_data'),
             'output': Path(f'/content/drive/MyDrive/Models/{config["training"]["output_model_name"]}'),
             'logs': Path('./logs')
         }
 
 
-def load_training_data(data_path: Path):
-    """Load and prepare training dataset."""
+def is_pretokenized(schema, tokenizer, max_seq_length: int) -> bool:
+    """Whether a shard's stored input_ids were produced by this tokenizer and max length."""
+    if 'input_ids' not in schema.names:
+        return False
+    metadata = schema.metadata or {}
+    return (
+        metadata.get(b'tokenizer') == tokenizer.name_or_path.encode()
+        and metadata.get(b'max_seq_length') == str(max_seq_length).encode()
+    )
+
+
+def load_training_data(data_path: Path, tokenizer, max_seq_length: int = None, streaming: bool = False):
+    """
+    Load the training data and pack it into fixed-length token blocks.
+
+    Tokenization runs once in parallel worker processes and is cached by
+    datasets, so epochs and reruns do not re-tokenize. With streaming,
+    shards are read and tokenized incrementally instead.
+
+    Args:
+        data_path: Directory of Parquet shards from 2_preprocess_data.py
+        tokenizer: Tokenizer of the base model
+        max_seq_length: Length of each packed block in tokens
+        streaming: Return an IterableDataset instead of materializing
+
+    Returns:
+        Dataset with input_ids, attention_mask and labels columns
+    """
+    import pyarrow.parquet as pq
+    from datasets import load_dataset
+
     print(f"Loading training data from: {data_path}")
 
+    if max_seq_length is None:
+        max_seq_length = config['training']['max_seq_length']
+
     if not data_path.exists():
         raise FileNotFoundError(
             f"Training data not found at {data_path}\n"
             f"Please run: python 2_preprocess_data.py"
         )
 
-    dataset = load_dataset('csv', data_files=str(data_path), split='train')
-    print(f"Loaded {len(dataset)} training examples")
+    data_files = sorted(str(f) for f in data_path.glob('*.parquet'))
+    schema = pq.read_schema(data_files[0])
+    columns = schema.names
+    pretokenized = is_pretokenized(schema, tokenizer, max_seq_length)
+    if 'input_ids' in columns and not pretokenized:
+        print(f"⚠ Stored input_ids do not match {tokenizer.name_or_path} at {max_seq_length} tokens; "
+              f"re-tokenizing from text")
+
+    dataset = load_dataset('parquet', data_files=data_files, split='train', streaming=streaming)
+    if streaming:
+        dataset = dataset.shuffle(buffer_size=10_000, seed=42)
+        map_kwargs = {}
+        print("Streaming training examples")
+    else:
+        map_kwargs = {'num_proc': os.cpu_count()}
+        print(f"Loaded {len(dataset)} training examples")
+
+    # Shards written with --pretokenize for this tokenizer already carry input_ids
+    if not pretokenized:
+        # Each text already carries its own <s> ... </s> boundary tokens
+        dataset = dataset.map(
+            # Packing fills every block, so no padding is needed
+            lambda batch: {'input_ids': tokenizer(
+                batch['text'],
+                truncation=True,
+                max_length=max_seq_length,
+                add_special_tokens=False,
+                padding=False,
+                return_tensors=None,
+            )['input_ids']},
+            batched=True,
+            batch_size=1000,
+            remove_columns=columns,
+            **map_kwargs,
+        )
+    else:
+        dataset = dataset.select_columns(['input_ids'])
+
+    def pack(batch):
+        # Concatenate the batch and cut it into max_seq_length blocks,
+        # dropping the remainder
+        ids = [token for seq in batch['input_ids'] for token in seq]
+        usable = len(ids) // max_seq_length * max_seq_length
+        blocks = [ids[i:i + max_seq_length] for i in range(0, usable, max_seq_length)]
+        return {
+            'input_ids': blocks,
+            'attention_mask': [[1] * max_seq_length for _ in blocks],
+            'labels': [list(block) for block in blocks],
+        }
+
+    dataset = dataset.map(
+        pack,
+        batched=True,
+        batch_size=1000,
+        remove_columns=['input_ids'],
+        **map_kwargs,
+    )
+    if not streaming:
+        print(f"Packed into {len(dataset)} sequences of {max_seq_length} tokens")
 
     return dataset
 
 
-def setup_model_and_tokenizer(model_name: str):
+def estimate_packed_sequences(data_path: Path, tokenizer, max_seq_length: int = None,
+                              sample_size: int = 1000) -> int:
+    """
+    Estimate how many packed blocks the data yields without reading it all.
+
+    Row counts come from the Parquet footers; tokens per row are measured
+    on a sample from the first shard.
     """
-    Setup model with 4-bit quantization and tokenizer.
+    import pyarrow.parquet as pq
+
+    if max_seq_length is None:
+        max_seq_length = config['training']['max_seq_length']
+
+    data_files = sorted(data_path.glob('*.parquet'))
+    num_rows = sum(pq.ParquetFile(f).metadata.num_rows for f in data_files)
+
+    first = pq.ParquetFile(data_files[0])
+    if is_pretokenized(first.schema_arrow, tokenizer, max_seq_length):
+        sample = first.read_row_group(0, columns=['input_ids']).column('input_ids')
+        lengths = [len(ids) for ids in sample.to_pylist()[:sample_size]]
+    else:
+        sample = first.read_row_group(0, columns=['text']).column('text').to_pylist()[:sample_size]
+        lengths = [
+            len(ids) for ids in tokenizer(
+                sample, truncation=True, max_length=max_seq_length, add_special_tokens=False
+            )['input_ids']
+        ]
+
+    avg_tokens = sum(lengths) / max(len(lengths), 1)
+    return max(1, int(num_rows * avg_tokens // max_seq_length))
+
+
+def get_world_size() -> int:
+    """Number of processes started by torchrun (1 when run directly)."""
+    return int(os.environ.get('WORLD_SIZE', 1))
+
+
+def get_attn_implementation() -> str:
+    """Use FlashAttention-2 on Ampere+ GPUs when installed, else PyTorch SDPA."""
+    import torch
+
+    if (
+        torch.cuda.is_available()
+        and torch.cuda.get_device_capability()[0] >= 8
+        and importlib.util.find_spec('flash_attn') is not None
+    ):
+        return "flash_attention_2"
+    return "sdpa"
+
+
+def use_bf16() -> bool:
+    """bf16 needs an Ampere+ GPU; older GPUs fall back to fp16."""
+    import torch
+
+    return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
+
+def load_tokenizer(model_name: str):
+    """Load the base model's tokenizer."""
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True, trust_remote_code=True)
+    if not tokenizer.is_fast:
+        raise ValueError(f"No fast (Rust) tokenizer available for {model_name}")
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+
+    print("✓ Tokenizer loaded")
+
+    return tokenizer
+
+
+def import_unsloth() -> bool:
+    """Import Unsloth if available. It patches transformers, so call this first."""
+    try:
+        import unsloth  # noqa: F401
+    except (ImportError, NotImplementedError):
+        return False
+    return True
+
+
+def quantized_cache_path(model_name: str, bnb_config) -> Path:
+    """Cache location for a base model quantized with the given settings."""
+    settings = json.dumps(bnb_config.to_dict(), sort_keys=True, default=str)
+    key = hashlib.sha256(settings.encode() + model_name.encode()).hexdigest()[:16]
+    return QUANTIZED_CACHE_DIR / f"{model_name.replace('/', '_')}-{key}"
+
+
+def setup_model(model_name: str, use_unsloth: bool = False, prequantized: bool = True):
+    """
+    Setup model with 4-bit quantization.
 
     Args:
         model_name: HuggingFace model name
+        use_unsloth: Load through Unsloth's patched Llama implementation
+        prequantized: Load a pre-quantized 4-bit mirror of the model if one exists
 
     Returns:
-        model, tokenizer
+        model
     """
+    import torch
+    from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+    from peft import prepare_model_for_kbit_training
+
+    # The mirror saves the fp16 download and the quantization pass
+    mirror = PREQUANTIZED_MODELS.get(model_name) if prequantized and config['training']['use_4bit'] else None
+    if mirror:
+        print(f"Using pre-quantized mirror of {model_name}")
+        model_name = mirror
+
     print(f"\nLoading base model: {model_name}")
     print("This may take several minutes...")
 
+    if use_unsloth:
+        from unsloth import FastLanguageModel
+
+        # Unsloth picks bf16/fp16 itself and loads NF4 with double quantization
+        model, _ = FastLanguageModel.from_pretrained(
+            model_name,
+            max_seq_length=config['training']['max_seq_length'],
+            load_in_4bit=True,
+            dtype=None,
+        )
+        print(f"Model memory footprint: {model.get_memory_footprint() / 1e9:.2f} GB")
+        print("✓ Model loaded (Unsloth)")
+        return model
+
+    attn_implementation = get_attn_implementation()
+    compute_dtype = torch.bfloat16 if use_bf16() else torch.float16
+    print(f"Attention implementation: {attn_implementation}")
+    print(f"Compute dtype: {compute_dtype}")
+
+    # QLoRA trains on NF4 weights with double-quantized scales
+    quant_type = config['training']['bnb_4bit_quant_type']
+    if quant_type != "nf4" and mirror:
+        print(f"⚠ bnb_4bit_quant_type '{quant_type}' ignored: {mirror} is quantized with 'nf4'")
+    elif quant_type != "nf4":
+        print(f"⚠ bnb_4bit_quant_type '{quant_type}' overridden to 'nf4' for training")
+
     # Quantization config for 4-bit training
     bnb_config = BitsAndBytesConfig(
         load_in_4bit=config['training']['use_4bit'],
-        bnb_4bit_quant_type=config['training']['bnb_4bit_quant_type'],
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=False,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=compute_dtype,
+        bnb_4bit_use_double_quant=True,
     )
 
+    # Under DDP each process holds a full replica on its own GPU; otherwise
+    # let accelerate place the model
+    if get_world_size() > 1:
+        device_map = {"": int(os.environ.get('LOCAL_RANK', 0))}
+    else:
+        device_map = "auto"
+
+    # Reuse a previously quantized copy when the model and settings match;
+    # its config.json, like a pre-quantized mirror's, carries the
+    # quantization config
+    cache_path = quantized_cache_path(model_name, bnb_config)
+    use_cache = bnb_config.load_in_4bit and not mirror and cache_path.exists()
+    if use_cache:
+        print(f"Using cached 4-bit model: {cache_path}")
+
     # Load model
     model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        quantization_config=bnb_config,
-        device_map="auto",
+        str(cache_path) if use_cache else model_name,
+        quantization_config=None if use_cache or mirror else bnb_config,
+        device_map=device_map,
         trust_remote_code=True,
+        attn_implementation=attn_implementation,
+        torch_dtype=compute_dtype,
     )
+    print(f"Model memory footprint: {model.get_memory_footprint() / 1e9:.2f} GB")
+
+    # A mirror's quantization config carries its own compute dtype; match
+    # the bf16/fp16 choice above
+    if mirror:
+        import bitsandbytes as bnb
+
+        for module in model.modules():
+            if isinstance(module, bnb.nn.Linear4bit):
+                module.compute_dtype = compute_dtype
+
+    # Save the quantized weights before k-bit preparation upcasts the rest
+    if bnb_config.load_in_4bit and not (use_cache or mirror) and int(os.environ.get('LOCAL_RANK', 0)) == 0:
+        print(f"Caching 4-bit model to: {cache_path}")
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        tmp_path.rename(cache_path)
+
+    # Prepare model for k-bit training with activation checkpointing
+    model = prepare_model_for_kbit_training(
+        model,
+        use_gradient_checkpointing=True,
+        gradient_checkpointing_kwargs=GRADIENT_CHECKPOINTING_KWARGS,
+    )
+    # Keep gradients flowing into the LoRA adapters through checkpointed blocks
+    model.enable_input_require_grads()
 
-    # Prepare model for k-bit training
-    model = prepare_model_for_kbit_training(model)
-
-    # Load tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-    tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.padding_side = "right"
-
-    print("✓ Model and tokenizer loaded")
+    print("✓ Model loaded")
 
-    return model, tokenizer
+    return model
 
 
-def setup_lora(model):
+def setup_lora(model, use_unsloth: bool = False):
     """
     Setup LoRA configuration for parameter-efficient fine-tuning.
 
     Args:
         model: Base model
+        use_unsloth: Attach adapters with Unsloth's fused LoRA kernels
 
     Returns:
         Model with LoRA adapters
     """
     lora_config_dict = config['training']['lora']
 
-    peft_config = LoraConfig(
-        r=lora_config_dict['r'],
-        lora_alpha=lora_config_dict['alpha'],
-        lora_dropout=lora_config_dict['dropout'],
-        bias="none",
-        task_type="CAUSAL_LM",
-        target_modules=lora_config_dict['target_modules']
-    )
+    target_modules = lora_config_dict['target_modules']
+    if target_modules == "all-linear":
+        target_modules = LLAMA_LINEAR_MODULES
+
+    if use_unsloth:
+        from unsloth import FastLanguageModel
+
+        model = FastLanguageModel.get_peft_model(
+            model,
+            r=lora_config_dict['r'],
+            lora_alpha=lora_config_dict['alpha'],
+            lora_dropout=lora_config_dict['dropout'],
+            bias="none",
+            target_modules=target_modules,
+            use_rslora=True,
+            use_gradient_checkpointing="unsloth",
+        )
+    else:
+        from peft import LoraConfig, get_peft_model
+
+        peft_config = LoraConfig(
+            r=lora_config_dict['r'],
+            lora_alpha=lora_config_dict['alpha'],
+            lora_dropout=lora_config_dict['dropout'],
+            bias="none",
+            task_type="CAUSAL_LM",
+            target_modules=target_modules,
+            # Scale by alpha/sqrt(r) so the learning rate holds across ranks
+            use_rslora=True,
+        )
 
-    model = get_peft_model(model, peft_config)
+        model = get_peft_model(model, peft_config)
 
     # Print trainable parameters
     trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -136,29 +440,42 @@ def setup_lora(model):
     return model
 
 
-def create_training_arguments(output_dir: Path, num_epochs: int, batch_size: int):
+def create_training_arguments(output_dir: Path, num_epochs: int, batch_size: int, grad_accum: int = 1,
+                              max_steps: int = -1, optim: str = "paged_adamw_8bit", report_to: str = "none"):
     """Create training arguments."""
+    import torch
+    from transformers import TrainingArguments
+
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    if report_to == "wandb":
+        # Log locally; sync later with `wandb sync` instead of HTTP calls mid-training
+        os.environ.setdefault("WANDB_MODE", "offline")
+
     return TrainingArguments(
         output_dir=str(output_dir),
         num_train_epochs=num_epochs,
         per_device_train_batch_size=batch_size,
-        gradient_accumulation_steps=1,
-        optim="paged_adamw_32bit",
+        gradient_accumulation_steps=grad_accum,
+        optim=optim,
+        gradient_checkpointing=True,
+        gradient_checkpointing_kwargs=GRADIENT_CHECKPOINTING_KWARGS,
         save_steps=0,  # Save only at the end
-        logging_steps=25,
+        logging_steps=50,
+        logging_first_step=True,
         learning_rate=config['training']['learning_rate'],
         weight_decay=0.001,
-        fp16=False,
-        bf16=False,
+        fp16=torch.cuda.is_available() and not use_bf16(),
+        bf16=use_bf16(),
         max_grad_norm=0.3,
-        max_steps=-1,
+        max_steps=max_steps,
         warmup_ratio=config['training']['warmup_ratio'],
-        group_by_length=True,
         lr_scheduler_type="cosine",
-        report_to="tensorboard",
+        report_to=report_to,
         save_total_limit=1,
+        # LoRA freezes most parameters, which the unused-parameter scan misreports
+        ddp_find_unused_parameters=False,
+        ddp_bucket_cap_mb=50,
     )
 
 
@@ -175,33 +492,52 @@ def train_model(
     Args:
         model: Model with LoRA adapters
         tokenizer: Tokenizer
-        dataset: Training dataset
+        dataset: Packed, tokenized training dataset
         training_args: Training arguments
         max_seq_length: Maximum sequence length
 
     Returns:
         Trained model
     """
+    from transformers import default_data_collator
+    from trl import SFTTrainer
+
     if max_seq_length is None:
         max_seq_length = config['training']['max_seq_length']
 
+    # The dataset is already tokenized and packed, so SFTTrainer uses it
+    # as-is and the blocks only need stacking
     trainer = SFTTrainer(
         model=model,
         train_dataset=dataset,
-        dataset_text_field="text",
         max_seq_length=max_seq_length,
         tokenizer=tokenizer,
         args=training_args,
-        packing=False,
+        packing=True,
+        data_collator=default_data_collator,
+        # load_training_data already tokenized and packed the blocks; a streamed
+        # dataset has no column names, so trl would not detect that on its own
+        dataset_kwargs={"skip_prepare_dataset": True},
+    )
+
+    effective_batch = (
+        training_args.per_device_train_batch_size
+        * training_args.gradient_accumulation_steps
+        * training_args.world_size
     )
 
     print("\n" + "=" * 60)
     print("Starting Training")
     print("=" * 60)
-    print(f"Number of examples: {len(dataset)}")
     print(f"Number of epochs: {training_args.num_train_epochs}")
     print(f"Batch size: {training_args.per_device_train_batch_size}")
-    print(f"Total steps: ~{len(dataset) * training_args.num_train_epochs // training_args.per_device_train_batch_size}")
+    print(f"Gradient accumulation steps: {training_args.gradient_accumulation_steps}")
+    print(f"Effective batch size: {effective_batch}")
+    if training_args.max_steps > 0:
+        print(f"Total steps: {training_args.max_steps}")
+    else:
+        print(f"Packed sequences: {len(dataset)}")
+        print(f"Total steps: ~{len(dataset) * training_args.num_train_epochs // effective_batch}")
     print("=" * 60)
 
     # Train
@@ -217,9 +553,18 @@ def save_model(trainer, model_path: Path):
     print(f"\nSaving model to: {model_path}")
     model_path.mkdir(parents=True, exist_ok=True)
 
-    trainer.model.save_pretrained(model_path)
+    # PEFT saves only the adapter weights, no base weights or optimizer state
+    trainer.model.save_pretrained(model_path, safe_serialization=True)
     trainer.tokenizer.save_pretrained(model_path)
 
+    # Fingerprint the adapter so the merge step can tell whether it changed
+    digest = hashlib.sha256()
+    for name in ('adapter_config.json', 'adapter_model.safetensors'):
+        with open(model_path / name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    (model_path / 'adapter.sha256').write_text(digest.hexdigest())
+
     print("✓ Model saved successfully")
 
 
@@ -228,15 +573,34 @@ def main():
     parser.add_argument('--local', action='store_true', help='Run in local mode (not Colab)')
     parser.add_argument('--epochs', type=int, default=5, help='Number of training epochs')
     parser.add_argument('--batch_size', type=int, default=4, help='Training batch size')
+    parser.add_argument('--grad_accum', type=int, default=None,
+                        help='Gradient accumulation steps (default: 8 local, 4 Colab)')
     parser.add_argument('--model', type=str, default=None, help='Base model name')
+    parser.add_argument('--optim', type=str, default='paged_adamw_8bit',
+                        choices=['paged_adamw_8bit', 'paged_lion_8bit', 'paged_adamw_32bit', 'adafactor'],
+                        help='Optimizer (8-bit paged states need bitsandbytes>=0.41)')
+    parser.add_argument('--report_to', type=str, default='none',
+                        choices=['none', 'tensorboard', 'wandb'],
+                        help='Where to send training logs (wandb runs offline)')
+    parser.add_argument('--no_unsloth', action='store_true',
+                        help='Do not use Unsloth kernels even if installed')
+    parser.add_argument('--no_prequantized', action='store_true',
+                        help='Quantize the original base model instead of loading a pre-quantized mirror')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Stream and tokenize the data on the fly instead of loading it up front')
 
     args = parser.parse_args()
 
+    if '8bit' in args.optim and version.parse(importlib.metadata.version('bitsandbytes')) < version.parse('0.41'):
+        parser.error(f"--optim {args.optim} requires bitsandbytes>=0.41")
+
     # Setup environment
     print("=" * 60)
     print("Jenkins Chatbot - Model Fine-Tuning")
     print("=" * 60)
 
+    import torch
+
     # Check for GPU
     if not torch.cuda.is_available():
         print("\n⚠ WARNING: No GPU detected!")
@@ -249,23 +613,39 @@ def main():
     # Setup paths
     paths = setup_paths(local_mode=args.local)
 
-    # Load data
-    dataset = load_training_data(paths['data'])
-
     # Get base model name
     base_model = args.model or config['training']['base_model']
 
-    # Setup model and tokenizer
-    model, tokenizer = setup_model_and_tokenizer(base_model)
+    # Unsloth's open-source kernels are single-GPU only
+    use_unsloth = not args.no_unsloth and get_world_size() == 1 and import_unsloth()
+
+    # Tokenize and pack data before the model takes up memory
+    tokenizer = load_tokenizer(base_model)
+    dataset = load_training_data(paths['data'], tokenizer, streaming=args.streaming)
+
+    # A streamed dataset has no length, so the trainer needs an explicit step count
+    grad_accum = args.grad_accum or (8 if args.local else 4)
+    max_steps = -1
+    if args.streaming:
+        num_sequences = estimate_packed_sequences(paths['data'], tokenizer)
+        max_steps = math.ceil(num_sequences * args.epochs / (args.batch_size * grad_accum * get_world_size()))
+        print(f"Estimated {num_sequences} packed sequences")
+
+    # Setup model
+    model = setup_model(base_model, use_unsloth=use_unsloth, prequantized=not args.no_prequantized)
 
     # Add LoRA adapters
-    model = setup_lora(model)
+    model = setup_lora(model, use_unsloth=use_unsloth)
 
     # Create training arguments
     training_args = create_training_arguments(
         output_dir=paths['output'],
         num_epochs=args.epochs,
-        batch_size=args.batch_size
+        batch_size=args.batch_size,
+        grad_accum=grad_accum,
+        max_steps=max_steps,
+        optim=args.optim,
+        report_to=args.report_to,
     )
 
     # Train
@@ -3,21 +3,49 @@ Step 4: Merge LoRA weights and convert to GGML format.
 This prepares the model for CPU inference in production.
 
 Usage:
-    python 4_merge_and_convert.py [--skip-merge] [--skip-quantize]
+    python 4_merge_and_convert.py [--skip-merge] [--skip-quantize] [--quant q4_K_M,q8_0]
 """
 import os
 import argparse
+import ctypes
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import shutil
 import subprocess
+import importlib.util
 from pathlib import Path
+from typing import Dict, List
 import yaml
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+
+# Rust-based parallel uploads; huggingface_hub reads this at import time
+if importlib.util.find_spec('hf_transfer') is not None:
+    os.environ.setdefault('HF_HUB_ENABLE_HF_TRANSFER', '1')
+
+# torch, transformers, peft and llama_cpp are imported where they are used,
+# so --help and the --skip-merge path do not pay for loading them
+HAS_LLAMA_CPP = importlib.util.find_spec('llama_cpp') is not None
 
 # Load config
 with open('config.yaml', 'r') as f:
     config = yaml.safe_load(f)
 
+# Conversion artifacts reused across runs, keyed by merged model fingerprint
+CACHE_DIR = Path.home() / ".cache" / "jenkins-ai"
+
+# llama.cpp revision bundled with the pinned llama-cpp-python, so the
+# converter writes GGUF files its quantizer can read
+LLAMA_CPP_REPO = "https://github.com/ggerganov/llama.cpp.git"
+LLAMA_CPP_COMMIT = "cfac111e2b3953cdb6b0126e67a2487687646971"
+
+# llama.cpp file types for each quantization choice
+LLAMA_FTYPES = {
+    'q4_0': 'LLAMA_FTYPE_MOSTLY_Q4_0',
+    'q4_K_M': 'LLAMA_FTYPE_MOSTLY_Q4_K_M',
+    'q5_0': 'LLAMA_FTYPE_MOSTLY_Q5_0',
+    'q5_1': 'LLAMA_FTYPE_MOSTLY_Q5_1',
+    'q8_0': 'LLAMA_FTYPE_MOSTLY_Q8_0',
+}
+
 
 def merge_lora_weights(
     base_model_name: str,
@@ -32,6 +60,10 @@ def merge_lora_weights(
         lora_weights_path: Path to LoRA weights
         output_path: Where to save merged model
     """
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from peft import PeftModel
+
     print("\n" + "=" * 60)
     print("Step 1: Merging LoRA Weights with Base Model")
     print("=" * 60)
@@ -42,115 +74,260 @@ def merge_lora_weights(
             f"Please run: python 3_finetune_model.py"
         )
 
+    # Skip the merge when this adapter was already merged onto this base model
+    adapter_hash = lora_weights_path / "adapter.sha256"
+    merge_marker = output_path / "merge.key"
+    merge_key = f"{base_model_name}\n{adapter_hash.read_text()}" if adapter_hash.exists() else None
+    if merge_key and merge_marker.exists() and merge_marker.read_text() == merge_key:
+        print(f"✓ Merged model at {output_path} is up to date, skipping merge")
+        return output_path
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    merge_marker.unlink(missing_ok=True)
+
+    # Tokenizer save is plain file I/O; run it alongside the merge
+    tokenizer_pool = ThreadPoolExecutor(max_workers=1)
+    tokenizer_saved = tokenizer_pool.submit(
+        lambda: AutoTokenizer.from_pretrained(base_model_name).save_pretrained(output_path)
+    )
+    tokenizer_pool.shutdown(wait=False)
+
     print(f"Loading base model: {base_model_name}")
     base_model = AutoModelForCausalLM.from_pretrained(
         base_model_name,
-        torch_dtype=torch.float16,
-        device_map="auto"
+        torch_dtype=torch.bfloat16,
+        device_map="auto",
+        use_safetensors=True,
+        low_cpu_mem_usage=True,
     )
 
     print(f"Loading LoRA weights from: {lora_weights_path}")
     model = PeftModel.from_pretrained(base_model, str(lora_weights_path))
 
+    # Each adapter is folded into its base weight in place, so no second
+    # copy of the model is allocated
     print("Merging weights...")
-    model = model.merge_and_unload()
+    model = model.merge_and_unload(progressbar=True)
 
     print(f"Saving merged model to: {output_path}")
-    output_path.mkdir(parents=True, exist_ok=True)
-    model.save_pretrained(output_path)
-
-    # Save tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(base_model_name)
-    tokenizer.save_pretrained(output_path)
+    model.save_pretrained(output_path, safe_serialization=True, max_shard_size="2GB")
+
+    # Re-raises a failed tokenizer save before the merge is marked done
+    tokenizer_saved.result()
+    missing = [name for name in ("config.json", "tokenizer_config.json") if not (output_path / name).exists()]
+    if not any(output_path.glob("*.safetensors")):
+        missing.append("*.safetensors")
+    if missing:
+        raise RuntimeError(f"Merged model at {output_path} is incomplete, missing: {', '.join(missing)}")
+    if merge_key:
+        merge_marker.write_text(merge_key)
 
     print("✓ Model merged and saved")
 
     return output_path
 
 
-def convert_to_gguf(model_path: Path, output_path: Path, quantization: str = "q8_0"):
-    """
-    Convert model to GGUF format and quantize.
+def model_fingerprint(model_path: Path) -> str:
+    """Cheap hash of a model directory from file names, sizes and mtimes."""
+    digest = hashlib.sha256()
+    for f in sorted(model_path.iterdir()):
+        if f.is_file():
+            stat = f.stat()
+            digest.update(f"{f.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
 
-    Args:
-        model_path: Path to merged model
-        output_path: Where to save GGUF model
-        quantization: Quantization type (q4_0, q5_0, q5_1, q8_0)
-    """
-    print("\n" + "=" * 60)
-    print("Step 2: Converting to GGUF Format")
-    print("=" * 60)
 
-    # Check if llama.cpp is available
-    llama_cpp_dir = Path("llama.cpp")
-
-    if not llama_cpp_dir.exists():
-        print("\nllama.cpp not found. Cloning repository...")
-        subprocess.run([
-            "git", "clone",
-            "https://github.com/ggerganov/llama.cpp.git"
-        ], check=True)
+def link_or_copy(src: Path, dst: Path):
+    """Hard-link a cached artifact into place, copying across filesystems."""
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
 
-    # Convert to GGUF (f16)
-    print("\nConverting to GGUF format (fp16)...")
-    f16_output = output_path / "model-f16.gguf"
-    output_path.mkdir(parents=True, exist_ok=True)
 
-    convert_script = llama_cpp_dir / "convert_hf_to_gguf.py"
+def ensure_llama_cpp(llama_cpp_dir: Path):
+    """Fetch only the pinned llama.cpp revision, without history."""
+    if llama_cpp_dir.exists():
+        return
 
+    print("\nllama.cpp not found. Fetching pinned revision...")
+    subprocess.run(["git", "init", "-q", str(llama_cpp_dir)], check=True)
     subprocess.run([
-        "python", str(convert_script),
-        str(model_path),
-        "--outtype", "f16",
-        "--outfile", str(f16_output)
+        "git", "-C", str(llama_cpp_dir), "fetch", "--depth", "1",
+        LLAMA_CPP_REPO, LLAMA_CPP_COMMIT
     ], check=True)
+    subprocess.run(["git", "-C", str(llama_cpp_dir), "checkout", "-q", "FETCH_HEAD"], check=True)
 
-    print(f"✓ F16 model saved to: {f16_output}")
 
-    # Build quantization tools if needed
+def build_quantize_tool(llama_cpp_dir: Path) -> Path:
+    """Build llama.cpp's llama-quantize binary if it is not already built."""
     quantize_tool = llama_cpp_dir / "build" / "bin" / "llama-quantize"
 
     if not quantize_tool.exists():
-        print("\nBuilding llama.cpp quantization tools...")
+        print("\nllama-cpp-python not installed. Building llama.cpp quantization tools...")
+        ensure_llama_cpp(llama_cpp_dir)
         build_dir = llama_cpp_dir / "build"
         build_dir.mkdir(exist_ok=True)
 
-        subprocess.run(["cmake", "-B", str(build_dir)], cwd=llama_cpp_dir, check=True)
-        subprocess.run(["cmake", "--build", str(build_dir), "--config", "Release"], check=True)
+        # CPU-only, and skip tests and the server; llama-quantize is an
+        # example target at the pinned commit, so examples stay enabled
+        subprocess.run([
+            "cmake", "-S", str(llama_cpp_dir), "-B", str(build_dir),
+            "-DCMAKE_BUILD_TYPE=Release",
+            "-DGGML_CUDA=OFF",
+            "-DLLAMA_BUILD_TESTS=OFF",
+            "-DLLAMA_BUILD_SERVER=OFF",
+        ], check=True)
+        subprocess.run([
+            "cmake", "--build", str(build_dir), "--config", "Release",
+            "--target", "llama-quantize", "-j", str(os.cpu_count()),
+        ], check=True)
+
+    return quantize_tool
+
+
+def quantize_gguf(f16_path: Path, output_path: Path, quantization: str, llama_cpp_dir: Path,
+                  nthread: int = 0):
+    """Quantize an f16 GGUF with llama-cpp-python, or a locally built llama-quantize."""
+    if HAS_LLAMA_CPP:
+        import llama_cpp
 
-    # Quantize model
-    print(f"\nQuantizing to {quantization}...")
-    quantized_output = output_path / f"model-{quantization}.gguf"
+        params = llama_cpp.llama_model_quantize_default_params()
+        params.ftype = getattr(llama_cpp, LLAMA_FTYPES[quantization])
+        params.nthread = nthread
+        ret = llama_cpp.llama_model_quantize(
+            str(f16_path).encode(), str(output_path).encode(), ctypes.byref(params)
+        )
+        if ret != 0:
+            raise RuntimeError(f"llama_model_quantize failed with code {ret}")
+        return
 
     subprocess.run([
-        str(quantize_tool),
-        str(f16_output),
-        str(quantized_output),
-        quantization
+        str(llama_cpp_dir / "build" / "bin" / "llama-quantize"),
+        str(f16_path),
+        str(output_path),
+        quantization,
+        str(nthread or os.cpu_count())
     ], check=True)
 
-    print(f"✓ Quantized model saved to: {quantized_output}")
+
+def prefetch(path: Path):
+    """Ask the kernel to start reading a file into the page cache."""
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def convert_to_gguf(model_path: Path, output_path: Path, quantizations: List[str]) -> Dict[str, Path]:
+    """
+    Convert model to GGUF format once and quantize it to each requested type.
+
+    Args:
+        model_path: Path to merged model
+        output_path: Where to save GGUF models
+        quantizations: Quantization types (q4_0, q4_K_M, q5_0, q5_1, q8_0)
+
+    Returns:
+        Mapping of quantization type to quantized model path
+    """
+    print("\n" + "=" * 60)
+    print("Step 2: Converting to GGUF Format")
+    print("=" * 60)
+
+    cache_dir = CACHE_DIR / model_fingerprint(model_path)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    # Only the Python conversion script is needed from llama.cpp
+    # when llama-cpp-python provides the quantizer
+    llama_cpp_dir = Path("llama.cpp")
+
+    # Convert to GGUF (f16)
+    f16_output = cache_dir / "model-f16.gguf"
+    if f16_output.exists():
+        print(f"\n✓ Using cached F16 model: {f16_output}")
+    else:
+        ensure_llama_cpp(llama_cpp_dir)
+
+        print("\nConverting to GGUF format (fp16)...")
+        convert_script = llama_cpp_dir / "convert_hf_to_gguf.py"
+        tmp_output = f16_output.with_suffix(".tmp")
+
+        subprocess.run([
+            "python", str(convert_script),
+            str(model_path),
+            "--outtype", "f16",
+            "--outfile", str(tmp_output)
+        ], check=True)
+        tmp_output.rename(f16_output)
+
+        print(f"✓ F16 model saved to: {f16_output}")
+
+    # Quantize all targets in parallel from the same f16 file
+    cached = {quant: cache_dir / f"model-{quant}.gguf" for quant in quantizations}
+    pending = [quant for quant in quantizations if not cached[quant].exists()]
+    for quant in quantizations:
+        if quant not in pending:
+            print(f"\n✓ Using cached {quant} model")
+
+    if pending:
+        if not HAS_LLAMA_CPP:
+            build_quantize_tool(llama_cpp_dir)
+
+        cpu_count = os.cpu_count() or 1
+        workers = min(len(pending), max(1, cpu_count // 4))
+        nthread = max(1, cpu_count // workers)
+        prefetch(f16_output)
+
+        print(f"\nQuantizing to {', '.join(pending)} ({workers} parallel)...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                quant: executor.submit(
+                    quantize_gguf, f16_output, cached[quant].with_suffix(".tmp"),
+                    quant, llama_cpp_dir, nthread
+                )
+                for quant in pending
+            }
+            for quant, future in futures.items():
+                future.result()
+                cached[quant].with_suffix(".tmp").rename(cached[quant])
+                print(f"✓ Quantized to {quant}")
+
+    quantized_outputs = {}
+    for quant in quantizations:
+        quantized_outputs[quant] = output_path / f"model-{quant}.gguf"
+        link_or_copy(cached[quant], quantized_outputs[quant])
+        print(f"✓ Quantized model saved to: {quantized_outputs[quant]}")
 
     # Show file sizes
     f16_size = f16_output.stat().st_size / (1024**3)
-    quant_size = quantized_output.stat().st_size / (1024**3)
 
     print("\n" + "=" * 60)
     print("Model Sizes:")
     print("=" * 60)
     print(f"F16 model: {f16_size:.2f} GB")
-    print(f"{quantization.upper()} model: {quant_size:.2f} GB")
-    print(f"Size reduction: {100 * (1 - quant_size/f16_size):.1f}%")
+    for quant, path in quantized_outputs.items():
+        quant_size = path.stat().st_size / (1024**3)
+        print(f"{quant.upper()} model: {quant_size:.2f} GB "
+              f"({100 * (1 - quant_size/f16_size):.1f}% smaller)")
 
-    return quantized_output
+    return quantized_outputs
 
 
-def upload_to_huggingface(model_path: Path, repo_id: str):
+def upload_to_huggingface(model_dir: Path, filenames: List[str], repo_id: str):
     """
-    Upload model to HuggingFace Hub.
+    Upload models to HuggingFace Hub.
+
+    Uses the resumable large-folder uploader, so an interrupted upload
+    continues where it stopped instead of starting over.
 
     Args:
-        model_path: Path to model
+        model_dir: Directory containing the models
+        filenames: Model files in model_dir to upload
         repo_id: HuggingFace repository ID (username/model-name)
     """
     print("\n" + "=" * 60)
@@ -169,13 +346,16 @@ def upload_to_huggingface(model_path: Path, repo_id: str):
     print("Run: huggingface-cli login")
 
     api = HfApi()
+    api.create_repo(repo_id=repo_id, repo_type="model", exist_ok=True)
 
-    print(f"\nUploading {model_path.name}...")
-    api.upload_file(
-        path_or_fileobj=str(model_path),
-        path_in_repo="model.bin",
+    print(f"\nUploading {', '.join(filenames)}...")
+    if os.environ.get('HF_HUB_ENABLE_HF_TRANSFER') == '1':
+        print("Using hf_transfer for parallel chunked uploads")
+    api.upload_large_folder(
         repo_id=repo_id,
-        repo_type="model"
+        folder_path=str(model_dir),
+        repo_type="model",
+        allow_patterns=filenames
     )
 
     print(f"✓ Model uploaded to: https://huggingface.co/{repo_id}")
@@ -186,12 +366,16 @@ def main():
     parser.add_argument('--skip-merge', action='store_true', help='Skip merging step')
     parser.add_argument('--skip-quantize', action='store_true', help='Skip quantization step')
     parser.add_argument('--upload', type=str, help='Upload to HuggingFace (provide repo_id)')
-    parser.add_argument('--quant', type=str, default='q8_0',
-                        choices=['q4_0', 'q5_0', 'q5_1', 'q8_0'],
-                        help='Quantization type')
+    parser.add_argument('--quant', type=str, default=config['conversion']['quantization_type'],
+                        help=f"Comma-separated quantization types ({', '.join(LLAMA_FTYPES)})")
 
     args = parser.parse_args()
 
+    quantizations = [quant.strip() for quant in args.quant.split(',') if quant.strip()]
+    unknown = [quant for quant in quantizations if quant not in LLAMA_FTYPES]
+    if not quantizations or unknown:
+        parser.error(f"invalid --quant {args.quant!r}; choose from {', '.join(LLAMA_FTYPES)}")
+
     print("=" * 60)
     print("Jenkins Chatbot - Model Conversion")
     print("=" * 60)
@@ -215,24 +399,28 @@ def main():
 
     # Step 2: Convert to GGUF and quantize
     if not args.skip_quantize:
-        quantized_model = convert_to_gguf(merged_path, gguf_path, args.quant)
+        quantized_models = convert_to_gguf(merged_path, gguf_path, quantizations)
     else:
         print("\n⏭ Skipping quantization step")
-        quantized_model = None
+        quantized_models = {}
 
     # Step 3: Upload to HuggingFace (optional)
-    if args.upload and quantized_model:
-        upload_to_huggingface(quantized_model, args.upload)
+    if args.upload and quantized_models:
+        filenames = [path.name for path in quantized_models.values()]
+        upload_to_huggingface(gguf_path, filenames, args.upload)
 
     print("\n" + "=" * 60)
     print("Conversion Complete!")
     print("=" * 60)
     print(f"\nMerged model: {merged_path}")
-    if quantized_model:
+    for quant, quantized_model in quantized_models.items():
         print(f"Quantized model: {quantized_model}")
+    if quantized_models:
+        quant = quantizations[0]
         print("\nTo use in production, update backend config:")
         print(f"  MODEL_NAME=path/to/gguf")
-        print(f"  MODEL_FILE=model-{args.quant}.gguf")
+        print(f"  MODEL_QUANTIZATION={quant}")
+        print(f"  MODEL_FILE=model-{quant}.gguf")
 
 
 if __name__ == "__main__":